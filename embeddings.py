@@ -0,0 +1,77 @@
+import os
+import numpy as np
+import onnxruntime
+import torch
+from langchain.embeddings.base import Embeddings
+from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoTokenizer
+
+QUANTIZED_MODEL_FILE = "model_quantized.onnx"
+
+
+class QuantizedMiniLMEmbeddings(Embeddings):
+    """
+    all-MiniLM-L6-v2 sentence embeddings run through ONNX Runtime with dynamic int8 quantization.
+
+    Constructor:
+        --model_name: Hugging Face id of the sentence-transformers model to export
+        --model_dir: folder holding the exported and quantized model, created on first use
+        --batch_size: number of texts encoded per ONNX Runtime call
+    """
+    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2", model_dir: str = "onnx_minilm", batch_size: int = 64):
+        if not os.path.exists(os.path.join(model_dir, QUANTIZED_MODEL_FILE)):
+            self._export(model_name, model_dir)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        # Parallelism comes from intra-op threads (ORT defaults them to one per physical core);
+        # a single sequential inter-op pool keeps ORT from competing with its own workers
+        session_options = onnxruntime.SessionOptions()
+        session_options.inter_op_num_threads = 1
+        session_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_dir, file_name=QUANTIZED_MODEL_FILE, session_options=session_options)
+        self.batch_size = batch_size
+
+    @staticmethod
+    def _export(model_name: str, model_dir: str):
+        """One-time ONNX export of model_name, quantized to int8 for VNNI-capable CPUs"""
+        model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+        model.save_pretrained(model_dir)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(model_dir)
+        quantizer = ORTQuantizer.from_pretrained(model)
+        quantization_config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+        quantizer.quantize(save_dir=model_dir, quantization_config=quantization_config)
+
+    def _encode(self, texts: list) -> np.ndarray:
+        """Mean-pool and L2-normalize the token embeddings of one batch, as sentence-transformers does"""
+        inputs = self.tokenizer(texts, padding=True, truncation=True, max_length=256, return_tensors="np")
+        hidden = self.model(**inputs).last_hidden_state
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def embed_documents(self, texts: list) -> list:
+        """Embed documents in length-sorted batches so each batch is only padded to its own longest text"""
+        order = np.argsort([len(text) for text in texts], kind="stable")
+        vectors = [None] * len(texts)
+        for start in range(0, len(texts), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for i, vector in zip(batch, self._encode([texts[i] for i in batch]).tolist()):
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text: str) -> list:
+        """Embed a single query string"""
+        return self._encode([text])[0].tolist()
+
+
+def load_minilm_embeddings() -> Embeddings:
+    """Pick the fastest MiniLM backend: PyTorch on CUDA when a GPU is present, int8 ONNX on CPU otherwise"""
+    if torch.cuda.is_available():
+        return SentenceTransformerEmbeddings(
+            model_name="all-MiniLM-L6-v2",
+            model_kwargs={"device": "cuda"},
+            encode_kwargs={"batch_size": 256}
+        )
+    return QuantizedMiniLMEmbeddings(batch_size=64)
@@ -1,14 +1,64 @@
+import asyncio
+import codecs
+import hashlib
+import math
+import random
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import shelve
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import faiss
+import numpy as np
 import tiktoken
 import openai
-from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
-from langchain.text_splitter import CharacterTextSplitter
 from langchain.vectorstores import FAISS
-from langchain.document_loaders import TextLoader
-from langchain.embeddings import HuggingFaceEmbeddings
+from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.schema import Document
+from langchain.embeddings import HuggingFaceEmbeddings
 from dotenv import load_dotenv
+from embeddings import load_minilm_embeddings
+
+# Per-file work is dominated by Hugging Face requests and disk reads, so threads overlap well
+WALK_WORKERS = 16
+# Maximum number of in-flight OpenAI summarization requests
+SUMMARY_CONCURRENCY = 20
+# Attempts per summary before the file is skipped; waits between attempts back off exponentially
+SUMMARY_RETRIES = 5
+# Attempts per image caption before the image is skipped; 429 and 503 (model loading) are retried
+CAPTION_RETRIES = 5
+# Corpora with at least this many chunks are stored as OPQ + IVF-PQ rather than a flat index;
+# below it a flat scan is cheap and there is little data to train the quantizers on
+QUANTIZE_MIN_VECTORS = 10_000
+# On-disk cache of chunk embeddings keyed by content hash, reused across indexing runs;
+# one shelf per embedding backend so fp32 CUDA and int8 ONNX vectors never mix
+EMBEDDING_CACHE = "emb_cache"
+# Bytes sniffed from the start of a file to decide whether it is text
+BINARY_SNIFF_BYTES = 8192
+# Chunk windows are measured in cl100k_base tokens and sized to fit MiniLM's 256-token input
+CHUNK_TOKENS = 200
+CHUNK_OVERLAP = 40
+
+
+@dataclass
+class DocBuffer:
+    """Columnar store for chunks awaiting embedding: parallel lists of texts and metadata"""
+    texts: list = field(default_factory=list)
+    metadatas: list = field(default_factory=list)
+
+    def append(self, text: str, metadata: dict):
+        self.texts.append(text)
+        self.metadatas.append(metadata)
+
+    def extend(self, texts: list, source: str):
+        """Add several chunks of the same source file"""
+        self.texts += texts
+        self.metadatas += [{"source": source} for _ in texts]
+
 
 class Indexer:
     """
@@ -28,13 +78,20 @@ class Indexer:
         
         self.base_folder = root
         self.master_db = None
-        self.sentence_embedding_function = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
-        self.code_descriptions = []
-        self.code_files = []
-        self.regular_files = []
-        self.image_files = [[],[]]
+        self._lock = threading.Lock()
+        self._enc = tiktoken.get_encoding("cl100k_base")
+        self.sentence_embedding_function = load_minilm_embeddings()
+        self.code_descriptions = DocBuffer()
+        self.code_files = DocBuffer()
+        self.regular_files = DocBuffer()
+        self.image_files = DocBuffer()
+        self._pending_summaries = []
         self.openai_api_key = os.getenv('OPENAI_API_KEY')
         self.hf_bearer_token = os.getenv('HF_BEARER_TOKEN')
+        # One keep-alive pool for every captioning request, sized so no walk worker waits on a connection
+        self._hf_session = requests.Session()
+        self._hf_session.headers.update({"Authorization": f"Bearer {self.hf_bearer_token}"})
+        self._hf_session.mount("https://", HTTPAdapter(pool_maxsize=WALK_WORKERS))
         self.image_file_types = ['.jpg', '.jpeg', '.png']
         self.code_file_types = {
             ".py": "Python source code",
@@ -85,83 +142,213 @@ class Indexer:
     def image_insertion(self, filename: str):
         """Generate and save VIT-GPT2 image caption + metadata for an image"""
         API_URL = "https://api-inference.huggingface.co/models/nlpconnect/vit-gpt2-image-captioning"
-        headers = {"Authorization": f"Bearer {self.hf_bearer_token}"}
         def query(fname):
             with open(fname, "rb") as f:
                 data = f.read()
-            response = requests.post(API_URL, headers=headers, data=data)
-            return response.json()
-        hf_response = query(filename)[0]['generated_text']
+            for attempt in range(CAPTION_RETRIES):
+                wait = 2 ** attempt + random.random()
+                try:
+                    response = self._hf_session.post(API_URL, data=data, timeout=30)
+                    payload = response.json()
+                except (requests.RequestException, ValueError) as e:
+                    # Network failure or a non-JSON gateway page; both are worth another try
+                    error = e
+                else:
+                    if response.ok and isinstance(payload, list) and payload and 'generated_text' in payload[0]:
+                        return payload[0]['generated_text']
+                    error = payload.get("error", response.status_code) if isinstance(payload, dict) else response.status_code
+                    if response.status_code not in (429, 503):
+                        break
+                    if isinstance(payload, dict) and "estimated_time" in payload:
+                        # Hugging Face reports how long the model needs to load
+                        wait = min(max(wait, payload["estimated_time"]), 60)
+                if attempt < CAPTION_RETRIES - 1:
+                    time.sleep(wait)
+            print(f"Skipping image {fname}: {error}")
+            return None
+        hf_response = query(filename)
+        if hf_response is None:
+            return
         if os.path.splitext(filename)[1] in self.image_file_types:
             hf_response = "A picture of " + hf_response
-        self.image_files[0].append(hf_response)
-        self.image_files[1].append({"source" : f"{filename}"})
+        with self._lock:
+            self.image_files.append(hf_response, {"source" : f"{filename}"})
+    
+    def num_tokens_from_string(self, string: str) -> int:
+        """Get the number of cl100k_base tokens for an input string"""
+        return len(self._enc.encode_ordinary(string))
+    
+    def _chunk(self, text: str):
+        """Split text into overlapping windows of CHUNK_TOKENS tokens, returning (chunks, token count)"""
+        ids = self._enc.encode_ordinary(text)
+        if not ids:
+            return [], 0
+        step = CHUNK_TOKENS - CHUNK_OVERLAP
+        chunks = [self._enc.decode(ids[start:start + CHUNK_TOKENS]) for start in range(0, max(len(ids) - CHUNK_OVERLAP, 1), step)]
+        return chunks, len(ids)
     
-    def num_tokens_from_string(self, string: str, encoding_name: str = "cl100k_base") -> int:
-        """Get the number of tokens for an input string"""
-        encoding = tiktoken.get_encoding(encoding_name)
-        num_tokens = len(encoding.encode(string))
-        return num_tokens
+    def process_code(self, file_path: str, file_type: str, code: str, num_tokens: int):
+        """Queue a source code file to be summarized by GPT-3.5-turbo"""
+        if num_tokens < 5000:
+            with self._lock:
+                self._pending_summaries.append((file_path, code, file_type))
     
-    def process_code(self, file_path: str, file_type: str):
+    async def _summarize_code(self, semaphore: asyncio.Semaphore, file_path: str, code: str, file_type: str):
         """Generate and save GPT-3.5-turbo's understanding of what a source code file does"""
-        loader = TextLoader(file_path)
-        code_doc = loader.load()
-        code = "".join([i.page_content for i in code_doc])
-        if self.num_tokens_from_string(code, "cl100k_base") < 5000:
-            prompt = query = f"Summarize the purpose of the following code:\n```\n{code}\n```"
-            messages = [{"role": "user", "content": prompt}]
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=messages,
-                temperature=0
-            )
-            code_doc[0].page_content = f'{file_type} {response.choices[0].message["content"]}'
-            self.code_descriptions.append(code_doc[0])
+        prompt = f"Summarize the purpose of the following code:\n```\n{code}\n```"
+        messages = [{"role": "user", "content": prompt}]
+        for attempt in range(SUMMARY_RETRIES):
+            try:
+                async with semaphore:
+                    response = await openai.ChatCompletion.acreate(
+                        model="gpt-3.5-turbo",
+                        messages=messages,
+                        temperature=0
+                    )
+                break
+            except (openai.error.RateLimitError, openai.error.APIError, openai.error.Timeout,
+                    openai.error.APIConnectionError, openai.error.ServiceUnavailableError) as e:
+                if attempt == SUMMARY_RETRIES - 1:
+                    print(f"Skipping summary of {file_path}: {e}")
+                    return
+                # Sleep outside the semaphore so a backing-off call doesn't hold a slot
+                await asyncio.sleep(2 ** attempt + random.random())
+            except openai.error.OpenAIError as e:
+                print(f"Skipping summary of {file_path}: {e}")
+                return
+        description = f'{file_type} {response.choices[0].message["content"]}'
+        self.code_descriptions.append(description, {"source": file_path})
+    
+    async def _summarize_pending(self):
+        """Summarize every queued source code file, at most SUMMARY_CONCURRENCY at a time"""
+        semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+        pending, self._pending_summaries = self._pending_summaries, []
+        await asyncio.gather(*(self._summarize_code(semaphore, *summary) for summary in pending))
+    
+    def _iter_files(self, base_folder: str):
+        """Yield (absolute path, extension) for every file with an extension below base_folder"""
+        # os.scandir's DirEntry caches the file type from readdir, avoiding a stat per entry
+        stack = [base_folder]
+        while stack:
+            folder = stack.pop()
+            try:
+                entries = os.scandir(folder)
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            stack.append(entry.path)
+                        continue
+                    extension = os.path.splitext(entry.name)[1]
+                    if extension != '':
+                        yield entry.path, extension
+    
+    @staticmethod
+    def _looks_binary(head: bytes) -> bool:
+        """Treat a file as binary if its first block has a NUL byte or isn't valid UTF-8"""
+        if b"\0" in head:
+            return True
+        try:
+            # Incremental decode tolerates a multi-byte character cut off at the end of the block
+            codecs.getincrementaldecoder("utf-8")().decode(head)
+        except UnicodeDecodeError:
+            return True
+        return False
+    
+    def _process_one(self, abs_path: str, extension: str):
+        """Do file-type-dependent behavior for a single file"""
+        if extension in self.image_file_types:
+            self.image_insertion(abs_path)
+        else:
+            with open(abs_path, "rb") as f:
+                head = f.read(BINARY_SNIFF_BYTES)
+                if self._looks_binary(head):
+                    return
+                text = (head + f.read()).decode("utf-8", errors="ignore")
+            # The chunker tokenizes the whole file anyway, so its count decides summary eligibility
+            chunks, num_tokens = self._chunk(text)
+            if extension in self.code_file_types:
+                self.process_code(abs_path, self.code_file_types[extension], text, num_tokens)
+                with self._lock:
+                    self.code_files.extend(chunks, abs_path)
+            else:
+                with self._lock:
+                    self.regular_files.extend(chunks, abs_path)
     
     def _walk(self, base_folder: str):
-        """Crawl the filesystem and do file-type-dependent behavior"""
+        """Crawl the filesystem and process files concurrently"""
         openai.api_key = self.openai_api_key
-        for root, dirnames, filenames in os.walk(base_folder):
-            for filename in filenames:
-                extension = os.path.splitext(filename)[1]
-                abs_path = f'{root}/{filename}'
-                if extension == '':
-                    continue
-                elif extension in self.image_file_types:
-                    self.image_insertion(abs_path)
-                else:
-                    # insert try/catch here
-                    loader = TextLoader(abs_path)
-                    documents = loader.load()
-                    text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-                    intermediate_docs = text_splitter.split_documents(documents)
-                    if extension in self.code_file_types:
-                        self.process_code(abs_path, self.code_file_types[extension])
-                        self.code_files += intermediate_docs
-                    else:
-                        self.regular_files += intermediate_docs
+        with ThreadPoolExecutor(max_workers=WALK_WORKERS) as executor:
+            futures = [executor.submit(self._process_one, abs_path, extension)
+                       for abs_path, extension in self._iter_files(base_folder)]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Drop queued files instead of draining the rest of the tree before re-raising
+                executor.shutdown(cancel_futures=True)
+                raise
+        asyncio.run(self._summarize_pending())
     
     def _clear_doclists(self):
-        """Resets the lists of langchain documents"""
-        self.code_descriptions = []
-        self.code_files = []
-        self.regular_files = []
-        self.image_files = [[],[]]
+        """Resets the buffers of pending documents"""
+        self.code_descriptions = DocBuffer()
+        self.code_files = DocBuffer()
+        self.regular_files = DocBuffer()
+        self.image_files = DocBuffer()
+        self._pending_summaries = []
     
     def index(self):
         """Public driver to index the file system"""
         self._walk(self.base_folder)
     
+    def _embed_texts(self, texts: list) -> list:
+        """Embed texts, reusing cached vectors for any content embedded on a previous run"""
+        keys = [hashlib.blake2b(text.encode(), digest_size=16).hexdigest() for text in texts]
+        backend = type(self.sentence_embedding_function).__name__
+        with shelve.open(f"{EMBEDDING_CACHE}-{backend}") as cache:
+            missing = {}
+            for key, text in zip(keys, texts):
+                if key not in cache:
+                    missing.setdefault(key, text)
+            for key, vector in zip(missing, self.sentence_embedding_function.embed_documents(list(missing.values()))):
+                cache[key] = vector
+            # Keep only the current corpus so the cache doesn't grow across runs
+            current = set(keys)
+            for key in [key for key in cache.keys() if key not in current]:
+                del cache[key]
+            return [cache[key] for key in keys]
+    
     def render_db(self):
         """Set instance's master_db to be a FAISS database"""
-        code_description_db = FAISS.from_documents(self.code_descriptions, self.sentence_embedding_function)
-        code_file_db = FAISS.from_documents(self.code_files, self.sentence_embedding_function)
-        master_db = FAISS.from_documents(self.regular_files, self.sentence_embedding_function)
-        master_db.add_texts(texts=self.image_files[0],metadatas=self.image_files[1])
-        master_db.merge_from(code_description_db)
-        master_db.merge_from(code_file_db)
-        self.master_db = master_db
+        # Everything lands in one index; file_type keeps the categories distinguishable
+        texts, metadatas = [], []
+        for buffer, file_type in [(self.code_descriptions, "code_description"), (self.code_files, "code"), (self.regular_files, "text"), (self.image_files, "image")]:
+            texts += buffer.texts
+            metadatas += [{**metadata, "file_type": file_type} for metadata in buffer.metadatas]
+        if not texts:
+            print("No documents to index")
+            return
+        # Embed the whole corpus in one batched pass rather than once per FAISS store
+        matrix = np.asarray(self._embed_texts(texts), dtype=np.float32)
+        doc_ids = [str(uuid.uuid4()) for _ in texts]
+        docstore = InMemoryDocstore({doc_id: Document(page_content=text, metadata=metadata)
+                                     for doc_id, text, metadata in zip(doc_ids, texts, metadatas)})
+        self.master_db = FAISS(self.sentence_embedding_function.embed_query, self._build_index(matrix), docstore, dict(enumerate(doc_ids)))
+    
+    def _build_index(self, matrix: np.ndarray):
+        """Flat L2 index for small corpora; trained OPQ-rotated IVF + 4-bit fast-scan PQ index for large ones"""
+        if len(matrix) < QUANTIZE_MIN_VECTORS:
+            index = faiss.IndexFlatL2(matrix.shape[1])
+        else:
+            nlist = int(math.sqrt(len(matrix)))
+            index = faiss.index_factory(matrix.shape[1], f"OPQ48,IVF{nlist},PQ48x4fs")
+            index.train(matrix)
+        # Row i of matrix becomes faiss id i, matching the index_to_docstore_id mapping
+        index.add(matrix)
+        return index
     
     def save_db(self):
         if self.master_db != None:
@@ -1,29 +1,86 @@
+import bisect
+import functools
 import requests
 import os
 import tiktoken
 import openai
-from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
+import faiss
 from langchain.text_splitter import CharacterTextSplitter
 from langchain.vectorstores import FAISS
 from langchain.document_loaders import TextLoader
 from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.schema import Document
 from dotenv import load_dotenv
+from embeddings import load_minilm_embeddings
+
+# Number of IVF lists scanned per query when the index is quantized
+NPROBE = 16
+# Chunks fetched per requested result, since several chunks of one file collapse into a single result
+FETCH_MULTIPLIER = 4
+# Put files whose name starts with a single-word query ahead of the semantic results
+PATH_FAST_PATH = True
+
+
+@functools.lru_cache(maxsize=1024)
+def _chat_completion(prompt: str) -> str:
+    """GPT-3.5-turbo answer to a single user prompt, memoized since temperature is 0"""
+    messages = [{"role": "user", "content": prompt}]
+    response = openai.ChatCompletion.create(
+        model="gpt-3.5-turbo",
+        messages=messages,
+        temperature=0, # this is the degree of randomness of the model's output
+    )
+    return response.choices[0].message["content"]
 
 
 class QueryDriver:
-    def __init__(self, embedding_model = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2"), optimizations = False):
-        self.embedding_model = embedding_model
+    def __init__(self, embedding_model = None, optimizations = False):
+        # Defaults to the int8 ONNX MiniLM on CPU (PyTorch on CUDA when available)
+        self.embedding_model = embedding_model if embedding_model is not None else load_minilm_embeddings()
+        # Repeated queries reuse their embedding and skip the MiniLM forward pass
+        self._embed_query = functools.lru_cache(maxsize=1024)(self.embedding_model.embed_query)
         self.master_db = None
         self.llm_optimizations = optimizations
+        self._path_index = []
     
     def load_from_memory(self, db_name):
         """Useful for instantiating QD's instance of FAISS vector store if it's already in memory"""
         self.master_db = db_name
+        self._tune_index()
+        self._build_path_index()
     
     def load_from_disk(self, path: str):
         """Instantiate QD's instance of FAISS vectore store if written to persisten storage"""
         self.master_db = FAISS.load_local(path, self.embedding_model)
+        self._tune_index()
+        self._build_path_index()
+        self._warm_up()
+    
+    def _tune_index(self):
+        """Set search-time parameters for quantized (IVF) indexes"""
+        ivf = faiss.try_extract_index_ivf(self.master_db.index)
+        if ivf is not None:
+            ivf.nprobe = NPROBE
+    
+    def _build_path_index(self):
+        """Sort (lowercase file name, source) pairs so file name prefixes can be found by bisection"""
+        sources = {document.metadata['source'] for document in self.master_db.docstore._dict.values()}
+        self._path_index = sorted((os.path.basename(source).lower(), source) for source in sources)
+    
+    def _search_paths(self, prefix: str, n_results=5):
+        """Files whose name starts with prefix, shortest paths first"""
+        prefix = prefix.lower()
+        i = bisect.bisect_left(self._path_index, (prefix,))
+        res = []
+        # Bound the scan so a one-letter prefix doesn't walk a large part of the index
+        while i < len(self._path_index) and len(res) < n_results * FETCH_MULTIPLIER and self._path_index[i][0].startswith(prefix):
+            res.append(self._path_index[i][1])
+            i += 1
+        return sorted(res, key=len)[:n_results]
+    
+    def _warm_up(self):
+        """Run a throwaway search so the first real query doesn't pay one-time model and index setup"""
+        self.master_db.similarity_search(query="warmup", k=1)
     
     def _search_database_vanilla(self, query: str, n_results=5):
         """Regular retrieval from vector DB"""
@@ -31,9 +88,14 @@ class QueryDriver:
             print("Vector store not loaded. Query class needs vector store to be loaded first")
             return
         res = []
-        for document in self.master_db.similarity_search(query=query, k=n_results):
-            if document.metadata['source'] not in res:
-                res.append(document.metadata['source'])
+        seen = set()
+        for document in self.master_db.similarity_search_by_vector(self._embed_query(query), k=n_results * FETCH_MULTIPLIER):
+            source = document.metadata['source']
+            if source not in seen:
+                seen.add(source)
+                res.append(source)
+                if len(res) == n_results:
+                    break
         return res
     
     def _search_database_image(self, query: str):
@@ -46,19 +108,8 @@ class QueryDriver:
         Query: {query}
         Generalized:"""
 
-        messages = [{"role": "user", "content": prompt}]
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            temperature=0, # this is the degree of randomness of the model's output
-        )
-
-        res = self._search_database_vanilla(f'{query}, which is {response.choices[0].message["content"]}', n_results=3)
-        regular_retrieval = self._search_database_vanilla(query=query, n_results=2)
-        for f in regular_retrieval:
-            if f not in res:
-                res.append(f)
-        return res
+        # One search over the query and its generalization instead of a separate search for each
+        return self._search_database_vanilla(f'{query}. Also described as: {_chat_completion(prompt)}', n_results=5)
     
     def _get_branch_likely(self,query):
         msg = f"""If the following query is looking for an image, output the word Image. \
@@ -67,13 +118,7 @@ class QueryDriver:
 
         Query: {query}.
         Output: """
-        messages = [{"role": "user", "content": msg}]
-        response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=messages,
-                temperature=0
-        )
-        return response.choices[0].message["content"]
+        return _chat_completion(msg)
     
     def _guided_database_search(self, search_string: str):
         """Use LLM optimized searching"""
@@ -83,9 +128,25 @@ class QueryDriver:
         else:
             return self._search_database_vanilla(search_string)
 
-    def query(self, search_string: str):
+    def query(self, search_string: str, n_results=5):
+        res = []
+        if PATH_FAST_PATH and len(search_string.split()) == 1:
+            res = self._search_paths(search_string.strip(), n_results=n_results)
+            if len(res) == n_results:
+                return res
         if not self.llm_optimizations:
-            return self._search_database_vanilla(search_string)
+            semantic = self._search_database_vanilla(search_string, n_results=n_results)
         else:
-            return self._guided_database_search(search_string)
+            semantic = self._guided_database_search(search_string)
+        if not res:
+            return semantic
+        # File name matches come first; semantic hits fill the remaining slots
+        seen = set(res)
+        for source in semantic or []:
+            if len(res) == n_results:
+                break
+            if source not in seen:
+                seen.add(source)
+                res.append(source)
+        return res
 
@@ -1,19 +1,20 @@
 from indexer import Indexer
 from query import QueryDriver
-from flask import Flask, request
+from flask import Flask, request, jsonify, current_app
 from flask_cors import CORS
 
 app = Flask(__name__)
 CORS(app)
+# Built at import, i.e. once per gunicorn worker; ORT and CUDA state must not cross a fork
 q = QueryDriver()
 q.load_from_disk("faiss_index")
+app.config["QUERY_DRIVER"] = q
 
 @app.route('/query', methods=['POST'])
 def query():
-    global q
     string = request.json['query']
-    res = q.query(string)
-    return {"result" : res}
+    res = current_app.config["QUERY_DRIVER"].query(string)
+    return jsonify({"result" : res})
 
 if __name__ == "__main__":
-    app.run(debug=True, port=8686)
\ No newline at end of file
+    app.run(port=8686)
\ No newline at end of file